@@ -1,5 +1,14 @@
 from flask import Flask, request, jsonify, render_template, redirect, url_for, session
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import sqlite3
+import threading
+import hashlib
+import socket
+import click
+import glob
+import json
+import time
 import os
 
 # Load .env when available (optional)
@@ -50,19 +59,112 @@ def require_login():
         return redirect(url_for('login'))
 
 
-def get_db():
-    conn = sqlite3.connect("/data/mtg.db")
+DB_PATH = os.environ.get('DB_PATH', '/data/mtg.db')
+
+# DB_SHARDS: unset or 0 keeps everyone in DB_PATH, N spreads users over N files,
+# 'user' gives every user their own file. DB_PATH then only holds system jobs.
+DB_SHARDS = os.environ.get('DB_SHARDS', '').strip().lower()
+if DB_SHARDS not in ('', 'user') and not DB_SHARDS.isdigit():
+    raise ValueError("DB_SHARDS must be empty, a number or 'user'")
+SHARDED = DB_SHARDS not in ('', '0')
+
+# paths whose schema has been created by this process
+ready_paths = set()
+
+# get_db() default: route by the logged-in user of the current request
+CURRENT_USER = object()
+
+# set once DB_PATH's meta table confirms the migrated shard layout matches DB_SHARDS
+shard_layout_checked = False
+
+
+class ShardLayoutMismatch(RuntimeError):
+    pass
+
+
+def shard_path(uid):
+    """Deterministic router from a user id to the database file holding that user's data."""
+    if not SHARDED or uid is None:
+        return DB_PATH
+    base, ext = os.path.splitext(DB_PATH)
+    # sha1 rather than hash() so every process routes the same way
+    digest = hashlib.sha1(str(uid).encode('utf-8')).hexdigest()
+    if DB_SHARDS == 'user':
+        return os.path.join(base + '-users', digest + ext)
+    return '%s-shard%d%s' % (base, int(digest, 16) % int(DB_SHARDS), ext)
+
+
+def shard_paths():
+    """Every database file that can hold user data."""
+    if not SHARDED:
+        return [DB_PATH]
+    base, ext = os.path.splitext(DB_PATH)
+    if DB_SHARDS == 'user':
+        return sorted(glob.glob(os.path.join(base + '-users', '*' + ext)))
+    return ['%s-shard%d%s' % (base, i, ext) for i in range(int(DB_SHARDS))]
+
+
+def connect(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def get_db(uid=CURRENT_USER):
+    """Connection to uid's shard; uid None is the system database (DB_PATH)."""
+    if uid is CURRENT_USER:
+        # raises outside a request, so background work must always pass uid
+        uid = current_user_id()
+    if uid is not None:
+        check_shard_layout()
+    path = shard_path(uid)
+    if path not in ready_paths:
+        init_db(path)
+    return connect(path)
+
+
+def get_system_db():
+    return get_db(None)
+
+
+def check_shard_layout():
+    # users' rows live where the last `flask migrate-shards` put them; any other
+    # layout would serve missing data, or DB_PATH's stale pre-migration copy
+    global shard_layout_checked
+    if shard_layout_checked:
+        return
+    conn = get_system_db()
+    row = conn.execute("SELECT value FROM meta WHERE key='shards'").fetchone()
+    conn.close()
+    migrated = row['value'] if row else None
+    if SHARDED and migrated is None:
+        raise ShardLayoutMismatch("DB_SHARDS=%s is set but `flask migrate-shards` has not been run for it" % DB_SHARDS)
+    if migrated is not None and migrated != (DB_SHARDS if SHARDED else None):
+        raise ShardLayoutMismatch(
+            "user data was migrated to DB_SHARDS=%s and the copy in %s is stale; set DB_SHARDS=%s"
+            % (migrated, DB_PATH, migrated))
+    shard_layout_checked = True
+
+
+@app.errorhandler(ShardLayoutMismatch)
+def shard_layout_mismatch(e):
+    return jsonify({"error": str(e)}), 503
+
+
 def current_user_id():
     user = session.get('user')
     return user.get('id') if user else None
 
 
-def init_db():
-    conn = get_db()
+def is_admin():
+    user = session.get('user') or {}
+    admins = [e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
+    return bool(user.get('email')) and user['email'].lower() in admins
+
+
+def init_db(path=DB_PATH):
+    conn = connect(path)
     c = conn.cursor()
 
     # Opponents
@@ -139,9 +241,39 @@ def init_db():
     # Trackers (per game)
     # (second trackers create is kept for compatibility; first above handles schema)
 
+    # Background jobs (heavy stats, exports, maintenance); user_id is NULL for system jobs
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            user_id TEXT,
+            params TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            progress INTEGER NOT NULL DEFAULT 0,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            started_at TEXT,
+            finished_at TEXT,
+            worker TEXT
+        )
+    """)
+
+    # Settings recorded by maintenance commands (e.g. which DB_SHARDS layout was migrated)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+
+    # WAL lets request threads keep reading while a job is writing
+    c.execute("PRAGMA journal_mode=WAL")
 
     conn.commit()
     conn.close()
+    ready_paths.add(path)
 
 
 @app.route("/")
@@ -507,12 +639,12 @@ def trackers(game_id):
     return jsonify([dict(r) for r in rows])
 
 
-@app.route("/api/stats/overall", methods=["GET"])
-def overall_stats():
-    conn = get_db()
+def compute_overall_stats(conn, uid, on_progress=None):
+    """Per-tracker breakdowns across all games for a user.
+
+    on_progress(done, total) is called after each tracker so background jobs can report progress.
+    """
     c = conn.cursor()
-    # Per-tracker breakdowns across all games for current user
-    uid = current_user_id()
     trackers_list = []
     distinct = c.execute("SELECT t.tracker, t.type FROM trackers t JOIN games g ON t.game_id = g.id WHERE g.user_id = ? GROUP BY t.tracker, t.type", (uid,)).fetchall()
     for row in distinct:
@@ -557,7 +689,18 @@ def overall_stats():
             """, (name, uid)).fetchall()
             item["distribution"] = [dict(r) for r in q]
         trackers_list.append(item)
+        if on_progress:
+            on_progress(len(trackers_list), len(distinct))
 
+    return trackers_list
+
+
+@app.route("/api/stats/overall", methods=["GET"])
+def overall_stats():
+    conn = get_db()
+    # Per-tracker breakdowns across all games for current user
+    uid = current_user_id()
+    trackers_list = compute_overall_stats(conn, uid)
     conn.close()
 
     return jsonify({"trackers": trackers_list})
@@ -690,6 +833,495 @@ def game_stats(game_id):
         "top_trackers": [dict(r) for r in top_trackers],
     })
 
+
+# -------- Background jobs --------
+# Heavy work runs on a small thread pool so it never ties up a request worker.
+# Job state lives in the jobs table so any worker process can report on it.
+# A user's jobs live in that user's shard; system jobs (uid None) live in DB_PATH.
+job_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('JOBS_WORKERS', '2')),
+    thread_name_prefix='job',
+)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def process_start(pid):
+    # start time in clock ticks since boot; tells a live pid apart from a reused one
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def worker_id():
+    """Identifies the process whose in-memory queue holds a job."""
+    pid = os.getpid()
+    return '%s:%d:%s' % (socket.gethostname(), pid, process_start(pid) or '')
+
+
+def worker_alive(worker):
+    if not worker:
+        return False
+    host, pid, start = worker.rsplit(':', 2)
+    if host != socket.gethostname():
+        # another machine's processes can't be checked from here
+        return True
+    pid = int(pid)
+    if start:
+        return process_start(pid) == start
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def job_progress(job, progress):
+    """Store progress (0-100) and stop the job if a cancel was requested."""
+    conn = connect(job['path'])
+    conn.execute("UPDATE jobs SET progress=? WHERE id=? AND user_id IS ?",
+                 (int(progress), job['id'], job['user_id']))
+    conn.commit()
+    row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=? AND user_id IS ?",
+                       (job['id'], job['user_id'])).fetchone()
+    conn.close()
+    if row and row['cancel_requested']:
+        raise JobCancelled()
+
+
+def job_stats(job, params):
+    uid = job['user_id']
+    conn = get_db(uid)
+    try:
+        trackers_list = compute_overall_stats(
+            conn, uid,
+            on_progress=lambda done, total: job_progress(job, done * 100 // total),
+        )
+    finally:
+        conn.close()
+    return {"trackers": trackers_list}
+
+
+def job_export(job, params):
+    uid = job['user_id']
+    # Everything owned by the user; players/trackers are owned through their game
+    queries = [
+        ("opponents", "SELECT id, name FROM opponents WHERE user_id=? ORDER BY id"),
+        ("decks", "SELECT id, opponent_id, name FROM decks WHERE user_id=? ORDER BY id"),
+        ("managed_trackers", "SELECT id, tracker, type FROM managed_trackers WHERE user_id=? ORDER BY id"),
+        ("games", "SELECT id, opponent_id, deck_id, timestamp FROM games WHERE user_id=? ORDER BY id"),
+        ("players", """
+            SELECT p.id, p.game_id, p.seat, p.opponent_id, p.deck_id
+            FROM players p JOIN games g ON p.game_id = g.id
+            WHERE g.user_id=? ORDER BY p.id
+        """),
+        ("trackers", """
+            SELECT t.id, t.game_id, t.tracker, t.count, t.type, t.player_seat
+            FROM trackers t JOIN games g ON t.game_id = g.id
+            WHERE g.user_id=? ORDER BY t.id
+        """),
+    ]
+    conn = get_db(uid)
+    result = {}
+    try:
+        for i, (name, sql) in enumerate(queries):
+            result[name] = [dict(r) for r in conn.execute(sql, (uid,)).fetchall()]
+            job_progress(job, (i + 1) * 100 // len(queries))
+    finally:
+        conn.close()
+    return result
+
+
+def job_maintenance(job, params):
+    # always every file: both the nightly system run and admin requests (ADMIN_JOB_KINDS)
+    paths = [DB_PATH] + [p for p in shard_paths() if p != DB_PATH and os.path.exists(p)]
+    databases = []
+    for i, path in enumerate(paths):
+        conn = connect(path)
+        try:
+            conn.execute("ANALYZE")
+            conn.execute("PRAGMA optimize")
+            checkpoint = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            if params.get("vacuum"):
+                conn.execute("VACUUM")
+        finally:
+            conn.close()
+        databases.append({"path": path, "wal_checkpoint": list(checkpoint) if checkpoint else None})
+        job_progress(job, (i + 1) * 100 // len(paths))
+    return {"databases": databases, "vacuum": bool(params.get("vacuum"))}
+
+
+def job_shard_stats(job, params):
+    # opens every shard (one file per user with DB_SHARDS=user), so it only runs as a job
+    paths = [p for p in shard_paths() if os.path.exists(p)]
+    shards = []
+    totals = {"users": 0, "games": 0, "trackers": 0, "total_hits": 0, "bytes": 0}
+    for i, path in enumerate(paths):
+        conn = connect(path)
+        try:
+            row = conn.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM (
+                        SELECT user_id FROM opponents
+                        UNION SELECT user_id FROM managed_trackers
+                        UNION SELECT user_id FROM games
+                    )) AS users,
+                    (SELECT COUNT(*) FROM games) AS games,
+                    (SELECT COUNT(*) FROM trackers) AS trackers,
+                    (SELECT COALESCE(SUM(count), 0) FROM trackers) AS total_hits
+            """).fetchone()
+        finally:
+            conn.close()
+        item = dict(row)
+        item["bytes"] = os.path.getsize(path)
+        for key in totals:
+            totals[key] += item[key]
+        item["path"] = path
+        shards.append(item)
+        job_progress(job, (i + 1) * 100 // len(paths))
+    return {"mode": DB_SHARDS if SHARDED else "single", "shards": shards, "totals": totals}
+
+
+JOB_KINDS = {
+    "stats": job_stats,
+    "export": job_export,
+    "maintenance": job_maintenance,
+    "shard_stats": job_shard_stats,
+}
+
+# ANALYZE/VACUUM lock the whole file, which every user shares unless sharded;
+# shard_stats reads every user's data
+ADMIN_JOB_KINDS = {"maintenance", "shard_stats"}
+
+
+def run_job(job_id, uid, path):
+    """Run a job from the database file it is stored in.
+
+    Job ids are only unique per file, so the row is always addressed by path
+    and owner rather than re-routed from uid.
+    """
+    conn = connect(path)
+    c = conn.cursor()
+    # claim the job unless it was cancelled while still queued
+    c.execute("""
+        UPDATE jobs SET status='running', started_at=datetime('now'), worker=?
+        WHERE id=? AND user_id IS ? AND status='pending' AND cancel_requested=0
+    """, (worker_id(), job_id, uid))
+    conn.commit()
+    if c.rowcount == 0:
+        c.execute("""
+            UPDATE jobs SET status='cancelled', finished_at=datetime('now')
+            WHERE id=? AND user_id IS ? AND status='pending'
+        """, (job_id, uid))
+        conn.commit()
+        conn.close()
+        return
+    row = c.execute("SELECT kind, params FROM jobs WHERE id=? AND user_id IS ?", (job_id, uid)).fetchone()
+    conn.close()
+
+    job = {"id": job_id, "user_id": uid, "path": path}
+    status, progress, result, error = 'done', 100, None, None
+    try:
+        result = JOB_KINDS[row['kind']](job, json.loads(row['params']))
+    except JobCancelled:
+        status, progress = 'cancelled', None
+    except Exception as e:
+        app.logger.exception("job %s (%s) failed", job_id, row['kind'])
+        status, progress, error = 'failed', None, str(e)
+
+    conn = connect(path)
+    conn.execute("""
+        UPDATE jobs
+        SET status=?, progress=COALESCE(?, progress), result=?, error=?, finished_at=datetime('now')
+        WHERE id=? AND user_id IS ?
+    """, (status, progress, json.dumps(result) if result is not None else None, error, job_id, uid))
+    conn.commit()
+    conn.close()
+
+
+def submit_job(kind, uid, params):
+    conn = get_db(uid)
+    c = conn.cursor()
+    c.execute(
+        "INSERT INTO jobs (kind, user_id, params, worker) VALUES (?, ?, ?, ?)",
+        (kind, uid, json.dumps(params), worker_id()),
+    )
+    job_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    job_executor.submit(run_job, job_id, uid, shard_path(uid))
+    return job_id
+
+
+def job_dict(row):
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+
+@app.route("/api/jobs", methods=["GET", "POST"])
+def jobs():
+    uid = current_user_id()
+    if not uid:
+        return jsonify({"error": "login required"}), 401
+
+    if request.method == "POST":
+        data = request.json or {}
+        kind = data.get("kind")
+        params = data.get("params") or {}
+        if kind not in JOB_KINDS:
+            return jsonify({"error": "kind must be one of: " + ", ".join(sorted(JOB_KINDS))}), 400
+        if not isinstance(params, dict):
+            return jsonify({"error": "params must be an object"}), 400
+        if kind in ADMIN_JOB_KINDS and not is_admin():
+            return jsonify({"error": "forbidden"}), 403
+        job_id = submit_job(kind, uid, params)
+        return jsonify({"id": job_id, "status": "pending"}), 202
+
+    conn = get_db()
+    rows = conn.execute("""
+        SELECT id, kind, user_id, params, status, progress, cancel_requested,
+               NULL AS result, error, created_at, started_at, finished_at
+        FROM jobs
+        WHERE user_id=?
+        ORDER BY id DESC
+        LIMIT 50
+    """, (uid,)).fetchall()
+    conn.close()
+    return jsonify([job_dict(r) for r in rows])
+
+
+@app.route("/api/jobs/<int:job_id>", methods=["GET", "DELETE"])
+def job_item(job_id):
+    conn = get_db()
+    c = conn.cursor()
+    uid = current_user_id()
+
+    exists = c.execute("SELECT id FROM jobs WHERE id=? AND user_id=?", (job_id, uid)).fetchone()
+    if not uid or not exists:
+        conn.close()
+        return jsonify({"error": "not found"}), 404
+
+    if request.method == "DELETE":
+        # cancellation is cooperative: running jobs stop at their next progress report
+        c.execute("UPDATE jobs SET cancel_requested=1 WHERE id=? AND status IN ('pending', 'running')", (job_id,))
+        c.execute("""
+            UPDATE jobs SET status='cancelled', finished_at=datetime('now')
+            WHERE id=? AND status='pending'
+        """, (job_id,))
+        conn.commit()
+
+    row = c.execute("""
+        SELECT id, kind, user_id, params, status, progress, cancel_requested,
+               result, error, created_at, started_at, finished_at
+        FROM jobs
+        WHERE id=?
+    """, (job_id,)).fetchone()
+    conn.close()
+    return jsonify(job_dict(row))
+
+
+def nightly_maintenance_loop(hour):
+    while True:
+        now = datetime.now()
+        next_run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        time.sleep((next_run - now).total_seconds())
+        try:
+            # every gunicorn worker runs this loop; the NOT EXISTS guard lets only one enqueue
+            conn = get_system_db()
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO jobs (kind, user_id, params, worker)
+                SELECT 'maintenance', NULL, '{}', ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM jobs
+                    WHERE kind = 'maintenance' AND user_id IS NULL
+                      AND created_at >= datetime('now', '-1 hour')
+                )
+            """, (worker_id(),))
+            job_id = c.lastrowid if c.rowcount == 1 else None
+            conn.commit()
+            conn.close()
+            if job_id:
+                job_executor.submit(run_job, job_id, None, DB_PATH)
+        except Exception:
+            app.logger.exception("failed to schedule nightly maintenance")
+
+
+def recover_jobs():
+    """Requeue pending jobs and fail running ones left behind by a process that has exited.
+
+    The queue itself only lives in job_executor, so a worker restart (deploy,
+    max_requests, crash) would otherwise leave its jobs pending or running forever.
+    """
+    me = worker_id()
+    paths = [DB_PATH] + [p for p in shard_paths() if p != DB_PATH and os.path.exists(p)]
+    for path in paths:
+        if path not in ready_paths:
+            init_db(path)
+        conn = connect(path)
+        c = conn.cursor()
+        rows = c.execute(
+            "SELECT id, user_id, status, worker FROM jobs WHERE status IN ('pending', 'running')"
+        ).fetchall()
+        for row in rows:
+            if path != shard_path(row['user_id']):
+                # left behind by an earlier DB_SHARDS layout; its user's data now lives elsewhere
+                c.execute("""
+                    UPDATE jobs
+                    SET status='failed', error='job was stored under a previous database layout', finished_at=datetime('now')
+                    WHERE id=? AND status IN ('pending', 'running')
+                """, (row['id'],))
+                conn.commit()
+                continue
+            if worker_alive(row['worker']):
+                continue
+            # the worker check in WHERE stops two restarting workers from both taking a job
+            if row['status'] == 'pending':
+                c.execute("UPDATE jobs SET worker=? WHERE id=? AND status='pending' AND worker IS ?",
+                          (me, row['id'], row['worker']))
+                conn.commit()
+                if c.rowcount == 1:
+                    job_executor.submit(run_job, row['id'], row['user_id'], path)
+            else:
+                c.execute("""
+                    UPDATE jobs
+                    SET status='failed', error='worker stopped before the job finished', finished_at=datetime('now')
+                    WHERE id=? AND status='running' AND worker IS ?
+                """, (row['id'], row['worker']))
+                conn.commit()
+        conn.close()
+
+
+def recover_jobs_safely():
+    try:
+        recover_jobs()
+    except Exception:
+        app.logger.exception("failed to recover orphaned jobs")
+
+
+def start_job_scheduler():
+    threading.Thread(target=recover_jobs_safely, daemon=True).start()
+
+    # JOBS_NIGHTLY_HOUR is local server time; set it empty to disable the nightly run
+    hour = os.environ.get('JOBS_NIGHTLY_HOUR', '3').strip()
+    if not hour:
+        return
+    threading.Thread(target=nightly_maintenance_loop, args=(int(hour),), daemon=True).start()
+
+
+# Started by the first request rather than at import, so `flask` CLI commands
+# and the debug reloader's watcher process never recover or run jobs.
+job_scheduler_started = False
+job_scheduler_lock = threading.Lock()
+
+
+@app.before_request
+def ensure_job_scheduler():
+    global job_scheduler_started
+    if job_scheduler_started:
+        return
+    with job_scheduler_lock:
+        if not job_scheduler_started:
+            start_job_scheduler()
+            job_scheduler_started = True
+
+
+# -------- Sharding: migration --------
+# Columns copied per table when moving a user out of DB_PATH; players and
+# trackers are owned through their game. Jobs are transient and not copied.
+SHARD_TABLES = [
+    ("opponents", "id, name, user_id", "user_id = ?"),
+    ("managed_trackers", "id, tracker, type, user_id", "user_id = ?"),
+    ("decks", "id, opponent_id, name, user_id", "user_id = ?"),
+    ("games", "id, opponent_id, deck_id, user_id, timestamp", "user_id = ?"),
+    ("players", "id, game_id, seat, opponent_id, deck_id",
+     "game_id IN (SELECT id FROM src.games WHERE user_id = ?)"),
+    ("trackers", "id, game_id, tracker, count, type, player_seat",
+     "game_id IN (SELECT id FROM src.games WHERE user_id = ?)"),
+]
+
+
+@app.cli.command('migrate-shards')
+def migrate_shards():
+    """Copy every user's rows from DB_PATH into their shard, then enable sharded routing."""
+    if not SHARDED:
+        raise click.ClickException("Set DB_SHARDS before migrating.")
+
+    src = get_system_db()
+    done = src.execute("SELECT value FROM meta WHERE key='shards'").fetchone()
+    if done:
+        src.close()
+        if done['value'] == DB_SHARDS:
+            click.echo("Already migrated to DB_SHARDS=%s." % DB_SHARDS)
+            return
+        raise click.ClickException(
+            "Already migrated to DB_SHARDS=%s; moving between shard layouts is not supported." % done['value'])
+
+    users = [r['user_id'] for r in src.execute("""
+        SELECT user_id FROM opponents
+        UNION SELECT user_id FROM managed_trackers
+        UNION SELECT user_id FROM games
+    """).fetchall() if r['user_id'] is not None]
+
+    by_path = {}
+    for uid in users:
+        by_path.setdefault(shard_path(uid), []).append(uid)
+
+    # ids are copied as-is, so a shard that already holds rows could collide or mix users
+    for path in sorted(set(shard_paths()) | set(by_path)):
+        if not os.path.exists(path):
+            continue
+        init_db(path)
+        conn = connect(path)
+        used = [t for t, _, _ in SHARD_TABLES if conn.execute("SELECT 1 FROM %s LIMIT 1" % t).fetchone()]
+        conn.close()
+        if used:
+            src.close()
+            raise click.ClickException("%s already holds rows in %s; move it aside and re-run." % (path, ", ".join(used)))
+
+    written = []
+    for path, uids in sorted(by_path.items()):
+        init_db(path)
+        conn = connect(path)
+        conn.execute("ATTACH DATABASE ? AS src", (DB_PATH,))
+        try:
+            for uid in uids:
+                for table, columns, where in SHARD_TABLES:
+                    conn.execute(
+                        "INSERT INTO main.%s (%s) SELECT %s FROM src.%s WHERE %s"
+                        % (table, columns, columns, table, where),
+                        (uid,),
+                    )
+            conn.commit()
+        except sqlite3.IntegrityError as e:
+            conn.rollback()
+            src.close()
+            raise click.ClickException(
+                "%s: %s. Shards already written: %s. Remove them before re-running."
+                % (path, e, ", ".join(written) or "none"))
+        finally:
+            conn.close()
+        written.append(path)
+        click.echo("%s: %d user(s)" % (path, len(uids)))
+
+    src.execute("INSERT INTO meta (key, value) VALUES ('shards', ?)", (DB_SHARDS,))
+    src.commit()
+    src.close()
+    click.echo("Migrated %d user(s) into %d shard(s); sharded routing is now enabled. "
+               "%s keeps a stale copy of the rows, and requests refuse to run unless DB_SHARDS=%s."
+               % (len(users), len(by_path), DB_PATH, DB_SHARDS))
+
 init_db()
 if __name__ == "__main__":
     init_db()